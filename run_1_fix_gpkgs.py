@@ -1,19 +1,38 @@
+import os
+
+# regions run in separate processes, keep each one single threaded to avoid oversubscription with GDAL/Arrow. this must
+# be set before numpy/pyarrow are imported so their thread pools pick it up
+os.environ['OMP_NUM_THREADS'] = '1'
+
 import logging
 import sys
 import glob
-import os
+import shutil
 import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
 
+import pyogrio
+
+from tdxhydrofixes.inputs import needs_corrections
 from tdxhydrofixes.inputs import stream_corrections
 from tdxhydrofixes.network import correct_0_length_basins
 
 logging.basicConfig(
     level=logging.INFO,
-    format='%(asctime)s %(levelname)s %(message)s',
+    format='%(asctime)s %(processName)s %(levelname)s %(message)s',
     datefmt='%Y-%m-%d %H:%M:%S',
     stream=sys.stdout,
 )
 
+# outputs are written to a temporary file and only moved into place once complete, so a failed write is simply
+# re-run and SQLite durability can be skipped for faster writes
+pyogrio.set_gdal_config_options({
+    'OGR_SQLITE_SYNCHRONOUS': 'OFF',
+    'OGR_SQLITE_JOURNAL': 'MEMORY',
+    'OGR_SQLITE_PRAGMA': 'temp_store=MEMORY',
+})
+
 inputs_path = '/Users/ricky/Downloads/test_tdxhydro'
 outputs_path = '/Users/ricky/Downloads/test_output'
 regions_to_select = '*'
@@ -29,26 +48,53 @@ ds_field = 'DSLINKNO'
 order_field = 'strmOrder'
 length_field = 'Length'
 
-if __name__ == '__main__':
-    for streams_gpg, basins_gpg in gis_iterable:
-        # Identify the region being processed
-        region_num = os.path.basename(streams_gpg)
-        region_num = region_num.split('_')[2]
-        region_num = int(region_num)
-
-        # log a bunch of stuff
-        logging.info('')
-        logging.info(region_num)
-        logging.info(streams_gpg)
-        logging.info(basins_gpg)
-
-        # output names
-        out_streams = os.path.join(outputs_path, os.path.basename(streams_gpg))
-        out_basins = os.path.join(outputs_path, os.path.basename(basins_gpg))
-
-        try:
-            # streams
-            if not os.path.exists(out_streams):
+n_workers = min(4, max(1, os.cpu_count() // 2))
+# number of times to restart the worker pool if a worker dies before giving up on the remaining regions
+max_pool_restarts = 2
+
+
+def write_gpkg(gdf, dst: str, layer: str) -> None:
+    # write under a temporary name, the layer is named explicitly so it does not take the temporary file name
+    tmp = os.path.join(os.path.dirname(dst), f'tmp_{os.path.basename(dst)}')
+    # pyogrio reopens an existing GPKG, so remove anything left behind by a crashed run
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    pyogrio.write_dataframe(gdf, tmp, layer=layer, driver='GPKG', use_arrow=True)
+    os.replace(tmp, dst)
+
+
+def copy_gpkg(src: str, dst: str) -> None:
+    tmp = os.path.join(os.path.dirname(dst), f'tmp_{os.path.basename(dst)}')
+    shutil.copyfile(src, tmp)
+    os.replace(tmp, dst)
+
+
+def process_region(streams_gpg: str, basins_gpg: str) -> bool:
+    # Identify the region being processed
+    region_num = os.path.basename(streams_gpg)
+    region_num = region_num.split('_')[2]
+    region_num = int(region_num)
+
+    # log a bunch of stuff
+    logging.info('')
+    logging.info(region_num)
+    logging.info(streams_gpg)
+    logging.info(basins_gpg)
+
+    # output names
+    out_streams = os.path.join(outputs_path, os.path.basename(streams_gpg))
+    out_basins = os.path.join(outputs_path, os.path.basename(basins_gpg))
+
+    try:
+        # regions with no 0 length streams or ID of 0 are copied without reading or rewriting the geometries. corrected
+        # regions are read and written with every column and keep the layer name of their input, same as a copy
+        region_needs_corrections = needs_corrections(streams_gpg, id_field=id_field, length_field=length_field)
+        if not region_needs_corrections:
+            logging.info('\tNo corrections needed, copying inputs')
+
+        # streams
+        if not os.path.exists(out_streams):
+            if region_needs_corrections:
                 steams_gdf = stream_corrections(streams_gpg,
                                     save_dir=outputs_path,
                                     id_field=id_field,
@@ -57,10 +103,13 @@ if __name__ == '__main__':
                                     region_num=region_num
                                     )               
                 logging.info('\tWriting Output Streams')
-                steams_gdf.to_file(out_streams, driver='GPKG')
+                write_gpkg(steams_gdf, out_streams, layer=pyogrio.list_layers(streams_gpg)[0][0])
+            else:
+                copy_gpkg(streams_gpg, out_streams)
 
-            # basins
-            if not os.path.exists(out_basins):
+        # basins
+        if not os.path.exists(out_basins):
+            if region_needs_corrections:
                 logging.info('Reading basins')
                 basins_gdf = correct_0_length_basins(basins_gpg,
                                         save_dir=outputs_path,
@@ -68,12 +117,70 @@ if __name__ == '__main__':
                                         region_num=region_num
                                         )
                 logging.info('\tWriting Output Basins')
-                basins_gdf.to_file(out_basins, driver='GPKG')
-                
-        except Exception as e:
-            logging.info('\n----- ERROR -----\n')
-            logging.info(e)
-            logging.error(traceback.format_exc())
-            continue
-
-    logging.info('All TDX Hydro Regions Processed')
\ No newline at end of file
+                write_gpkg(basins_gdf, out_basins, layer=pyogrio.list_layers(basins_gpg)[0][0])
+            else:
+                copy_gpkg(basins_gpg, out_basins)
+            
+    except Exception as e:
+        logging.info('\n----- ERROR -----\n')
+        logging.info(e)
+        logging.error(traceback.format_exc())
+        return False
+
+    return True
+
+
+def run_regions(regions: list) -> tuple:
+    """
+    Process regions in a pool of workers
+
+    Returns:
+        tuple, (regions not processed because the pool broke, regions that failed)
+    """
+    unfinished = []
+    failed = []
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        futures = {executor.submit(process_region, streams_gpg, basins_gpg): (streams_gpg, basins_gpg)
+                   for streams_gpg, basins_gpg in regions}
+        for i, future in enumerate(as_completed(futures), start=1):
+            region_name = os.path.basename(futures[future][0])
+            try:
+                ok = future.result()
+            except BrokenProcessPool:
+                # a worker died (e.g. killed for running out of memory), every pending region fails with this error
+                unfinished.append(futures[future])
+                continue
+            if not ok:
+                failed.append(futures[future])
+            logging.info(f'{"Finished" if ok else "Failed"} region {region_name} ({i}/{len(futures)})')
+    return unfinished, failed
+
+
+if __name__ == '__main__':
+    # skip regions whose outputs were already written by a previous run
+    regions = [
+        (streams_gpg, basins_gpg) for streams_gpg, basins_gpg in gis_iterable
+        if not (os.path.exists(os.path.join(outputs_path, os.path.basename(streams_gpg))) and
+                os.path.exists(os.path.join(outputs_path, os.path.basename(basins_gpg))))
+    ]
+
+    failed = []
+    for attempt in range(max_pool_restarts + 1):
+        regions, attempt_failed = run_regions(regions)
+        failed += attempt_failed
+        if not regions:
+            break
+        logging.error(f'Worker pool broke with {len(regions)} regions unfinished')
+        if attempt < max_pool_restarts:
+            logging.error('Restarting the worker pool for the unfinished regions')
+
+    if regions:
+        logging.error(f'Run stopped, {len(regions)} regions were not processed:')
+        for streams_gpg, _ in regions:
+            logging.error(f'\t{os.path.basename(streams_gpg)}')
+    if failed:
+        logging.error(f'{len(failed)} regions failed:')
+        for streams_gpg, _ in failed:
+            logging.error(f'\t{os.path.basename(streams_gpg)}')
+    if not regions and not failed:
+        logging.info('All TDX Hydro Regions Processed')
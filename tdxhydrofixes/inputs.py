@@ -2,24 +2,51 @@ import logging
 import os
 
 import geopandas as gpd
+import numpy as np
 import pandas as pd
+import pyogrio
 
 # set up logging
 logger = logging.getLogger(__name__)
 
+from .network import ARROW_TO_PANDAS_KWARGS
 from .network import correct_0_length_streams
 from .network import identify_0_length
 
 __all__ = [
+    'needs_corrections',
     'stream_corrections',
 ]
 
+def needs_corrections(streams_gpg: str,
+                      id_field: str = 'LINKNO',
+                      length_field: str = 'Length') -> bool:
+    """
+    Check if a stream network has any 0 length segments or a segment with an ID of 0
+
+    Only the matching rows are read, without geometry, so regions that need no corrections can be copied as is.
+
+    Args:
+        streams_gpg: str, path to the streams geopackage
+        id_field: str, field name for the link id
+        length_field: str, field name for the length of the stream segment
+
+    Returns:
+        bool
+    """
+    return not pyogrio.read_dataframe(streams_gpg,
+                                      columns=[id_field],
+                                      where=f'"{length_field}" = 0 OR "{id_field}" = 0',
+                                      read_geometry=False,
+                                      max_features=1).empty
+
 def stream_corrections(streams_gpg: str,
                 save_dir: str,
                 id_field: str = 'LINKNO',
                 ds_id_field: str = 'DSLINKNO',
                 length_field: str = 'Length', 
-                region_num: int = 0) -> gpd.GeoDataFrame:
+                region_num: int = 0,
+                columns: list = None) -> gpd.GeoDataFrame:
     """
     Correct stream network, prep files for basin corrections
 
@@ -39,6 +66,9 @@ def stream_corrections(streams_gpg: str,
         id_field: str, field name for the link id
         ds_id_field: str, field name for the downstream link id
         length_field: str, field name for the length of the stream segment
+        region_num: int, region number used to name the mod files
+        columns: list, optional attribute columns to read in addition to the id, downstream, upstream and length
+            fields. If None, all columns are read.
         default_k: float, default velocity factor (k) for Muskingum routing
         default_x: float, default attenuation factor (x) for Muskingum routing
 
@@ -52,21 +82,28 @@ def stream_corrections(streams_gpg: str,
     Returns:
         None
     """
-    sgdf = gpd.read_file(streams_gpg)
+    if columns is not None:
+        required = [id_field, ds_id_field, 'USLINKNO1', 'USLINKNO2', length_field]
+        columns = required + [c for c in columns if c not in required]
+    sgdf = gpd.read_file(streams_gpg, engine='pyogrio', use_arrow=True, columns=columns,
+                         arrow_to_pandas_kwargs=ARROW_TO_PANDAS_KWARGS)
 
     logger.info('\tRemoving 0 length segments')
-    if 0 in sgdf[length_field].values:
-        zero_length_fixes_df = identify_0_length(sgdf, id_field, ds_id_field, length_field)
+    zero_mask = sgdf[length_field].to_numpy() == 0
+    if zero_mask.any():
+        zero_length_fixes_df = identify_0_length(sgdf, id_field, ds_id_field, length_field, zero_mask=zero_mask)
         zero_length_fixes_df.to_csv(os.path.join(save_dir, f'mod_zero_length_streams_{region_num}.csv'), index=False)
         sgdf = correct_0_length_streams(sgdf, zero_length_fixes_df, id_field, ds_id_field)
 
     # Fix basins with ID of 0
-    if 0 in sgdf[id_field].values:
+    id_zero_idx = np.flatnonzero(sgdf[id_field].to_numpy() == 0)
+    if id_zero_idx.size:
         logger.info('\Found basins with ID of 0')
+        zero_centroid = sgdf.geometry.iat[int(id_zero_idx[0])].centroid
         pd.DataFrame({
             id_field: [0, ],
-            'centroid_x': sgdf[sgdf[id_field] == 0].centroid.x.values[0],
-            'centroid_y': sgdf[sgdf[id_field] == 0].centroid.y.values[0]
+            'centroid_x': zero_centroid.x,
+            'centroid_y': zero_centroid.y
         }).to_csv(os.path.join(save_dir, f'mod_basin_zero_centroid_{region_num}.csv'), index=False)
 
     return sgdf
@@ -1,5 +1,6 @@
 import logging
 import os
+from collections import deque
 
 import geopandas as gpd
 import numpy as np
@@ -14,10 +15,14 @@ __all__ = [
 
 logger = logging.getLogger(__name__)
 
+# split_blocks keeps each arrow column as its own numpy block instead of consolidating them into a 2D copy
+ARROW_TO_PANDAS_KWARGS = {'split_blocks': True}
+
 def identify_0_length(gdf: gpd.GeoDataFrame,
                       stream_id_col: str,
                       ds_id_col: str,
-                      length_col: str, ) -> pd.DataFrame:
+                      length_col: str,
+                      zero_mask: np.ndarray = None, ) -> pd.DataFrame:
     """
     Fix streams that have 0 length.
     General Error Cases:
@@ -40,44 +45,42 @@ def identify_0_length(gdf: gpd.GeoDataFrame,
         Field in stream network that corresponds to the unique downstream id of each stream segment
     length_col : string
         Field in basins network that corresponds to the unique length of each stream segment
+    zero_mask : np.ndarray, optional
+        Boolean array marking the rows of gdf with 0 length. Computed from length_col if not given
     """
-    case1_ids = []
-    case2_ids = []
-    case3_ids = []
-    case4_ids = []
-
-    for rivid in gdf[gdf[length_col] == 0][stream_id_col].values:
-        feat = gdf[gdf[stream_id_col] == rivid]
-
-        # Case 1
-        if feat[ds_id_col].values == -1 and feat['USLINKNO1'].values == -1 and feat['USLINKNO2'].values == -1:
-            case1_ids.append(rivid)
-
-        # Case 2
-        elif feat[ds_id_col].values != -1 and feat['USLINKNO1'].values != -1 and feat['USLINKNO2'].values != -1:
-            case2_ids.append(rivid)
-
-        # Case 3
-        elif feat[ds_id_col].values == -1 and feat['USLINKNO1'].values != -1 and feat['USLINKNO2'].values != -1:
-            case3_ids.append(rivid)
-
-        # Case 4
-        else:
-            logging.warning(f"The stream segment {feat[stream_id_col]} has conditions we've not yet considered")
-            case4_ids.append(rivid)
-
-    # variable length lists with np.nan to make them the same length
-    longest_list = max([len(case1_ids), len(case2_ids), len(case3_ids), len(case4_ids), ])
-    case1_ids = case1_ids + [np.nan] * (longest_list - len(case1_ids))
-    case2_ids = case2_ids + [np.nan] * (longest_list - len(case2_ids))
-    case3_ids = case3_ids + [np.nan] * (longest_list - len(case3_ids))
-    case4_ids = case4_ids + [np.nan] * (longest_list - len(case4_ids))
-
+    ids = gdf[stream_id_col].to_numpy()
+    ds = gdf[ds_id_col].to_numpy()
+    u1 = gdf['USLINKNO1'].to_numpy()
+    u2 = gdf['USLINKNO2'].to_numpy()
+    lenmask = gdf[length_col].to_numpy() == 0 if zero_mask is None else zero_mask
+
+    # classify only the 0 length rows, comparing each column to -1 once and assigning every row a case code
+    zero_idx = np.flatnonzero(lenmask)
+    ids = ids[zero_idx]
+    no_ds = ds[zero_idx] == -1
+    no_u1 = u1[zero_idx] == -1
+    no_u2 = u2[zero_idx] == -1
+    case_codes = np.select(
+        [
+            no_ds & no_u1 & no_u2,  # Case 1
+            ~no_ds & ~no_u1 & ~no_u2,  # Case 2
+            no_ds & ~no_u1 & ~no_u2,  # Case 3
+        ],
+        [1, 2, 3],
+        default=4,  # Case 4
+    )
+
+    # group the ids by case with one stable sort, keeping their original order within each case
+    case_counts = np.bincount(case_codes, minlength=5)[1:]
+    case1_ids, case2_ids, case3_ids, case4_ids = np.split(
+        ids[np.argsort(case_codes, kind='stable')], np.cumsum(case_counts)[:-1])
+    for rivid in case4_ids:
+        logging.warning(f"The stream segment {rivid} has conditions we've not yet considered")
+
+    # variable length columns are padded with pd.NA while keeping an integer dtype
     return pd.DataFrame({
-        'case1': case1_ids,
-        'case2': case2_ids,
-        'case3': case3_ids,
-        'case4': case4_ids,
+        case: pd.Series(case_ids, dtype='Int64')
+        for case, case_ids in zip(('case1', 'case2', 'case3', 'case4'), (case1_ids, case2_ids, case3_ids, case4_ids))
     })
 
 def correct_0_length_streams(sgdf: gpd.GeoDataFrame,
@@ -95,41 +98,74 @@ def correct_0_length_streams(sgdf: gpd.GeoDataFrame,
     Returns:
 
     """
+    ids_arr = sgdf[id_field].to_numpy()
+    ds_arr = sgdf[ds_id_field].to_numpy().copy()
+    us1_arr = sgdf['USLINKNO1'].to_numpy()
+    us2_arr = sgdf['USLINKNO2'].to_numpy()
+    # hash the id column once and reuse it for every id lookup below
+    id_index = pd.Index(ids_arr)
+    if not id_index.is_unique:
+        duplicates = id_index[id_index.duplicated()].unique().tolist()
+        raise ValueError(f'{id_field} must be unique to correct 0 length streams, found duplicates: {duplicates[:10]}')
+    # connectivity changes are made to ds_arr in place and all rows are dropped with one mask at the end
+    keep = np.ones(len(sgdf), dtype=bool)
+
     # Case 1 - Coastal w/ no upstream or downstream - Delete the stream and its basin
-    c1 = zero_length_df['case1'].dropna().astype(int).values
-    sgdf = sgdf[~sgdf[id_field].isin(c1)]
+    c1_pos = id_index.get_indexer(zero_length_df['case1'].dropna().to_numpy(dtype=np.int64))
+    keep[c1_pos[c1_pos >= 0]] = False
 
     # Case 3 - Coastal w/ upstreams but no downstream - Assign small non-zero length
     # Apply before case 2 to handle some edges cases where zero length basins drain into other zero length basins
-    c3_us_ids = sgdf[sgdf[id_field].isin(zero_length_df['case3'].dropna().values)][
-        ['USLINKNO1', 'USLINKNO2']].values.flatten()
-    sgdf.loc[sgdf[id_field].isin(c3_us_ids), ds_id_field] = -1
-    sgdf = sgdf[~sgdf[id_field].isin(zero_length_df['case3'].dropna().values)]
+    c3_pos = id_index.get_indexer(zero_length_df['case3'].dropna().to_numpy(dtype=np.int64))
+    c3_pos = c3_pos[c3_pos >= 0]
+    c3_us_pos = id_index.get_indexer(np.concatenate([us1_arr[c3_pos], us2_arr[c3_pos]]))
+    ds_arr[c3_us_pos[c3_us_pos >= 0]] = -1
+    keep[c3_pos] = False
 
     # Case 2 - Allow 3-river confluence - Delete the temporary basin and modify the connectivity properties
-    # Sort by DSLINKNO to handle some edges cases where zero length basins drain into other zero length basins
-    c2 = sgdf[sgdf[id_field].isin(zero_length_df['case2'].dropna().astype(int).values)]
-    c2 = c2.sort_values(by=[ds_id_field], ascending=True)
-    c2 = c2[id_field].values
-    for river_id in c2:
-        ids_to_apply = sgdf.loc[sgdf[id_field] == river_id, ['USLINKNO1', 'USLINKNO2', ds_id_field]]
-        # if the downstream basin is also a zero length basin, find the basin 1 step further downstream
-        if ids_to_apply[ds_id_field].values[0] in c2:
-            ids_to_apply[ds_id_field] = \
-                sgdf.loc[sgdf[id_field] == ids_to_apply[ds_id_field].values[0], ds_id_field].values[0]
-        sgdf.loc[
-            sgdf[id_field].isin(ids_to_apply[['USLINKNO1', 'USLINKNO2']].values.flatten()), ds_id_field] = \
-            ids_to_apply[ds_id_field].values[0]
+    c2_pos = id_index.get_indexer(zero_length_df['case2'].dropna().to_numpy(dtype=np.int64))
+    c2_pos = c2_pos[c2_pos >= 0]
+    c2 = ids_arr[c2_pos]
+    ds_of = dict(zip(c2, ds_arr[c2_pos]))
+    us_of = {}
+    for river_id, ds_id in ds_of.items():
+        us_of.setdefault(ds_id, []).append(river_id)
+
+    # resolve each zero length segment to the first segment downstream that is not zero length. segments are visited in
+    # reverse topological order, starting from those that drain to a non zero length segment, so that the downstream
+    # segment of each one has always been resolved already
+    queue = deque(river_id for river_id, ds_id in ds_of.items() if ds_id not in ds_of)
+    resolved = {river_id: ds_of[river_id] for river_id in queue}
+    while queue:
+        node = queue.popleft()
+        for us_id in us_of.get(node, []):
+            resolved[us_id] = resolved[node]
+            queue.append(us_id)
+    # anything left is in, or drains into, a cycle of zero length segments which are all deleted. there is no segment
+    # downstream to connect to so treat it as an outlet rather than point at a deleted segment
+    for river_id in ds_of.keys() - resolved.keys():
+        logger.warning(f'The zero length stream segment {river_id} is in or drains into a cycle of zero length '
+                       f'segments, its upstreams will be given a downstream id of -1')
+        resolved[river_id] = -1
+
+    # point the upstreams of each zero length segment at the resolved downstream segment
+    new_ds = np.fromiter((resolved[river_id] for river_id in c2), dtype=ds_arr.dtype, count=len(c2))
+    us_pos = id_index.get_indexer(np.concatenate([us1_arr[c2_pos], us2_arr[c2_pos]]))
+    has_us = us_pos >= 0
+    ds_arr[us_pos[has_us]] = np.tile(new_ds, 2)[has_us]
+    keep[c2_pos] = False
 
     # Remove the rows corresponding to the rivers to be deleted
-    sgdf = sgdf[~sgdf[id_field].isin(c2)]
+    sgdf = sgdf.take(np.flatnonzero(keep))
+    sgdf[ds_id_field] = ds_arr[keep]
 
     return sgdf
 
 def correct_0_length_basins(basins_gpg: str,
                             save_dir: str,
                             stream_id_col: str, 
-                            region_num: int) -> gpd.GeoDataFrame:
+                            region_num: int,
+                            columns: list = None) -> gpd.GeoDataFrame:
     """
     Apply fixes to streams that have 0 length.
 
@@ -137,11 +173,16 @@ def correct_0_length_basins(basins_gpg: str,
         basins_gpg: Basins to correct
         save_dir: Directory to save the corrected basins to
         stream_id_col:
+        region_num: Region number used to find the mod files
+        columns: Optional attribute columns to read in addition to stream_id_col. If None, all columns are read.
 
     Returns:
 
     """
-    basin_gdf = gpd.read_file(basins_gpg)
+    if columns is not None:
+        columns = [stream_id_col] + [c for c in columns if c != stream_id_col]
+    basin_gdf = gpd.read_file(basins_gpg, engine='pyogrio', use_arrow=True, columns=columns,
+                              arrow_to_pandas_kwargs=ARROW_TO_PANDAS_KWARGS)
 
     zero_fix_csv_path = os.path.join(save_dir, f'mod_basin_zero_centroid_{region_num}.csv')
     if os.path.exists(zero_fix_csv_path):
@@ -163,15 +204,14 @@ def correct_0_length_basins(basins_gpg: str,
     zero_length_csv_path = os.path.join(save_dir, f'mod_zero_length_streams_{region_num}.csv')
     if os.path.exists(zero_length_csv_path):
         logger.info('\tRevising basins with 0 length streams')
-        zero_length_df = pd.read_csv(zero_length_csv_path)
+        zero_length_df = pd.read_csv(zero_length_csv_path, dtype='Int64')
         # Case 1 - Coastal w/ no upstream or downstream - Delete the stream and its basin
-        logger.info('\tHandling Case 1 0 Length Streams - delete basins')
-        basin_gdf = basin_gdf[~basin_gdf[stream_id_col].isin(zero_length_df['case1'])]
         # Case 2 - Allow 3-river confluence - basin does not exist (try to delete just in case)
-        logger.info('\tHandling Case 2 0 Length Streams - delete basins')
-        basin_gdf = basin_gdf[~basin_gdf[stream_id_col].isin(zero_length_df['case2'])]
         # Case 3 - Coastal w/ upstreams but no downstream - basin exists so delete it
-        logger.info('\tHandling Case 3 0 Length Streams - delete basins')
-        basin_gdf = basin_gdf[~basin_gdf[stream_id_col].isin(zero_length_df['case3'])]
+        logger.info('\tHandling Case 1, 2, and 3 0 Length Streams - delete basins')
+        drop_ids = np.concatenate([
+            zero_length_df[c].dropna().to_numpy(dtype=np.int64) for c in ('case1', 'case2', 'case3')
+        ])
+        basin_gdf = basin_gdf.loc[~basin_gdf[stream_id_col].isin(drop_ids)]
 
     return basin_gdf.reset_index(drop=True)